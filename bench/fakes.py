@@ -0,0 +1,280 @@
+"""Local stand-ins for boto, psycopg2 and the dd-agent checks module.
+
+install() registers them in sys.modules so that the checks in checks.d can
+be loaded and run without AWS, a Redshift cluster or the agent.
+"""
+import copy
+import datetime
+import random
+import sys
+import time
+import types
+
+
+class Settings(object):
+    tables = 5000
+    nodes = 4
+    clusters = 20
+    load_balancers = 20
+    backends = 2000
+    # seconds added to every AWS API call and every SQL statement
+    api_latency = 0.0
+    sql_latency = 0.0
+    connect_latency = 0.0
+
+
+settings = Settings()
+
+calls = {
+    'describe_clusters': 0,
+    'describe_instance_health': 0,
+    'get_all_load_balancers': 0,
+    'connect': 0,
+    'execute': 0,
+    'metadata': 0,
+}
+
+
+# checks
+
+class AgentCheck(object):
+    OK, WARNING, CRITICAL, UNKNOWN = (0, 1, 2, 3)
+    DEFAULT_MIN_COLLECTION_INTERVAL = 0
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        import logging
+        self.name = name
+        self.init_config = init_config or {}
+        self.agentConfig = agentConfig
+        self.instances = instances
+        self.log = logging.getLogger('checks.%s' % name)
+        self.metric_count = 0
+        self.service_check_count = 0
+        self.warnings = []
+
+    def gauge(self, metric, value, tags=None, hostname=None, device_name=None, timestamp=None):
+        self.metric_count += 1
+
+    def increment(self, metric, value=1, tags=None, hostname=None, device_name=None):
+        self.metric_count += 1
+
+    def count(self, metric, value=0, tags=None, hostname=None, device_name=None):
+        self.metric_count += 1
+
+    def service_check(self, check_name, status, tags=None, timestamp=None, hostname=None,
+                      check_run_id=None, message=None):
+        self.service_check_count += 1
+
+    def warning(self, warning_message):
+        self.warnings.append(str(warning_message))
+
+    def run(self):
+        """Call check() with a copy of every instance, as the agent collector does.
+
+        The agent records a failing instance in its status, here the error is
+        raised so that a broken scenario does not go unnoticed.
+        """
+        for instance in self.instances or []:
+            self.check(copy.deepcopy(instance))
+
+    def stop(self):
+        pass
+
+
+# psycopg2
+
+class Error(Exception):
+    pass
+
+
+class QueryCanceledError(Error):
+    pass
+
+
+class Cursor(object):
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self._rows = []
+        self._pos = 0
+
+    def execute(self, query, params=None):
+        calls['execute'] += 1
+        if settings.sql_latency:
+            time.sleep(settings.sql_latency)
+        self._rows = self._result(query, params)
+        self._pos = 0
+
+    def _result(self, query, params):
+        limit = settings.tables
+        if 'limit' in query and params:
+            limit = min(limit, params[-1])
+
+        if 'stv_wlm_query_state' in query:
+            rows = [('wlm', str(service_class), 2.0, 5.0, 1.5) for service_class in range(6, 10)]
+            rows += [('disk', str(node), 1000.0 * node, 190000.0, 0.0) for node in range(settings.nodes)]
+            return rows + [('inflight', '', 12.0, 0.0, 0.0)]
+        if 'pg_table_def' in query:
+            return [(settings.tables,)]
+        if 'stv_slices' in query:
+            return [(node, settings.tables * 1000 // settings.nodes) for node in range(settings.nodes)]
+        if 'stv_tbl_perm' in query:
+            if 'svv_table_info' in query:
+                return [('table_%05d' % i, 1000 * i, 100 + i) for i in range(limit)]
+            return [('table_%05d' % i, 1000 * i) for i in range(limit)]
+        if 'svv_table_info' in query:
+            return [('table_%05d' % i, 100 + i, 1000 * i, 1.5) for i in range(limit)]
+        if 'svl_qlog' in query:
+            now = datetime.datetime.utcnow()
+            return [(query_type, random.randint(0, 1000), now) for query_type in params[-1]]
+        return [(1,)]
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def fetchmany(self, size):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def close(self):
+        self._rows = []
+
+
+class Connection(object):
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+
+    def cursor(self, name=None):
+        return Cursor(self, name)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def connect(**kwargs):
+    calls['connect'] += 1
+    if settings.connect_latency:
+        time.sleep(settings.connect_latency)
+    return Connection()
+
+
+# boto
+
+def _api_call(name):
+    calls[name] += 1
+    if settings.api_latency:
+        time.sleep(settings.api_latency)
+
+
+class RedshiftConnection(object):
+    page_size = 100
+
+    def describe_clusters(self, cluster_identifier=None, max_records=None, marker=None):
+        _api_call('describe_clusters')
+        start = int(marker or 0)
+        end = min(start + self.page_size, settings.clusters)
+        clusters = [{
+            'ClusterIdentifier': 'cluster-%d' % i,
+            'Endpoint': {'Address': 'cluster-%d.example.com' % i, 'Port': 5439},
+        } for i in range(start, end)]
+        return {'DescribeClustersResponse': {'DescribeClustersResult': {
+            'Clusters': clusters,
+            'Marker': str(end) if end < settings.clusters else None,
+        }}}
+
+
+class InstanceState(object):
+    def __init__(self, instance_id, state, reason_code):
+        self.instance_id = instance_id
+        self.state = state
+        self.reason_code = reason_code
+
+
+class ResultSet(list):
+    next_marker = None
+
+
+class LoadBalancer(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class ELBConnection(object):
+    page_size = 400
+
+    def describe_instance_health(self, load_balancer_name, instances=None):
+        _api_call('describe_instance_health')
+        states = []
+        for i in range(settings.backends):
+            if i % 50 == 0:
+                states.append(InstanceState('i-%08x' % i, 'OutOfService', 'Instance'))
+            elif i % 97 == 0:
+                states.append(InstanceState('i-%08x' % i, 'Unknown', 'ELB'))
+            else:
+                states.append(InstanceState('i-%08x' % i, 'InService', 'N/A'))
+        return states
+
+    def get_all_load_balancers(self, load_balancer_names=None, marker=None):
+        _api_call('get_all_load_balancers')
+        start = int(marker or 0)
+        end = min(start + self.page_size, settings.load_balancers)
+        result = ResultSet(LoadBalancer('elb-%d' % i) for i in range(start, end))
+        if end < settings.load_balancers:
+            result.next_marker = str(end)
+        return result
+
+
+def redshift_connect_to_region(region_name, **kwargs):
+    return RedshiftConnection()
+
+
+def elb_connect_to_region(region_name, **kwargs):
+    return ELBConnection()
+
+
+def get_instance_metadata(version='latest', url='http://169.254.169.254', data='meta-data/',
+                          timeout=None, num_retries=5):
+    calls['metadata'] += 1
+    if data == 'meta-data/placement/':
+        return {'availability-zone': 'us-east-1a'}
+    return {'placement': {'availability-zone': 'us-east-1a'}}
+
+
+class Provider(object):
+    def __init__(self, name, access_key=None, secret_key=None, security_token=None, profile_name=None):
+        self.access_key = access_key or 'AKIDEXAMPLE'
+        self.secret_key = secret_key or 'secret'
+        self.security_token = security_token
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    _module('checks', AgentCheck=AgentCheck)
+    psycopg2 = _module('psycopg2', Error=Error, connect=connect)
+    psycopg2.extensions = _module('psycopg2.extensions', QueryCanceledError=QueryCanceledError)
+
+    boto = _module('boto')
+    boto.redshift = _module('boto.redshift', connect_to_region=redshift_connect_to_region)
+    boto.utils = _module('boto.utils', get_instance_metadata=get_instance_metadata)
+    boto.provider = _module('boto.provider', Provider=Provider)
+    boto.ec2 = _module('boto.ec2')
+    boto.ec2.elb = _module('boto.ec2.elb', connect_to_region=elb_connect_to_region)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Offline benchmarks for the checks in checks.d.
+
+Runs AwsRedshiftStatus.check() and AwsEc2ElbCheck.check() against the local
+stand-ins in fakes.py and reports run time, peak memory and metrics emitted
+per run. Each scenario runs in its own process so that the peak RSS belongs
+to that scenario alone.
+
+    python bench/run_benchmarks.py --tables 20000 --sql-latency 0.01
+    python bench/run_benchmarks.py --save baseline.json
+    python bench/run_benchmarks.py --compare baseline.json --tolerance 0.2
+"""
+import argparse
+import imp
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_check(module_name, class_name):
+    module = imp.load_source('bench_%s' % module_name, os.path.join(ROOT, 'checks.d', '%s.py' % module_name))
+    return getattr(module, class_name)
+
+
+def redshift_scenario(args, workdir, **options):
+    init_config = {
+        'pool_size': 1,
+        'endpoint_cache_file': os.path.join(workdir, 'endpoints.json'),
+        'query_log_state_file': os.path.join(workdir, 'qlog.json'),
+        'query_results_file': os.path.join(workdir, 'results.json'),
+        'max_tables': args.max_tables,
+    }
+    init_config.update(options.get('init_config', {}))
+    instances = []
+    for i in range(args.instances):
+        instance = {
+            'name': 'bench-%d' % i,
+            'db_name': 'dev',
+            'user_name': 'bench',
+            'user_password': 'bench',
+            'aws_region': 'us-east-1',
+            'query': True,
+            'tags': ['bench'],
+        }
+        if options.get('discovery'):
+            instance['cluster_name'] = 'cluster-%d' % (i % fakes.settings.clusters)
+        else:
+            instance['cluster_address'] = 'cluster-%d.example.com' % i
+            instance['cluster_port'] = 5439
+        instances.append(instance)
+    check_class = load_check('aws_redshift_status', 'AwsRedshiftStatus')
+    return check_class('aws_redshift_status', init_config, {}, instances)
+
+
+def elb_scenario(args, workdir, **options):
+    init_config = {'max_workers': args.max_workers}
+    instances = []
+    for i in range(args.instances):
+        instance = {'aws_region': 'us-east-1', 'tags': ['bench']}
+        if options.get('discovery'):
+            instance['discover_load_balancers'] = True
+        else:
+            instance['load_balancer_names'] = ['elb-%d' % n for n in range(fakes.settings.load_balancers)]
+        instances.append(instance)
+    check_class = load_check('aws_ec2_elb_check', 'AwsEc2ElbCheck')
+    return check_class('aws_ec2_elb_check', init_config, {}, instances)
+
+
+SCENARIOS = [
+    ('redshift', redshift_scenario, {}),
+    ('redshift_stream', redshift_scenario, {'init_config': {'stream_results': True}}),
+    ('redshift_discovery', redshift_scenario, {'discovery': True}),
+    ('redshift_changes', redshift_scenario, {'init_config': {'emit_changes_only': True}}),
+    ('elb', elb_scenario, {}),
+    ('elb_discovery', elb_scenario, {'discovery': True}),
+]
+
+
+def run_scenario(args, name):
+    fakes.settings.tables = args.tables
+    fakes.settings.backends = args.backends
+    fakes.settings.load_balancers = args.load_balancers
+    fakes.settings.clusters = args.clusters
+    fakes.settings.api_latency = args.api_latency
+    fakes.settings.sql_latency = args.sql_latency
+    fakes.settings.connect_latency = args.connect_latency
+    fakes.install()
+
+    factory, options = [(f, o) for n, f, o in SCENARIOS if n == name][0]
+    workdir = tempfile.mkdtemp(prefix='dd-bench-')
+    try:
+        check = factory(args, workdir, **options)
+        durations = []
+        metrics = []
+        for _ in range(args.runs):
+            before = check.metric_count
+            start = time.time()
+            check.run()
+            durations.append(time.time() - start)
+            metrics.append(check.metric_count - before)
+        check.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'name': name,
+        'runs': args.runs,
+        'mean_time': sum(durations) / len(durations),
+        'min_time': min(durations),
+        'max_time': max(durations),
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'metrics_per_run': sum(metrics) / len(metrics),
+        'warnings': len(check.warnings),
+        'calls': fakes.calls,
+    }
+
+
+def spawn(argv, name):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--scenario', name] + argv)
+    return json.loads(output)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            continue
+        for key in ('mean_time', 'peak_rss_mb', 'metrics_per_run'):
+            if previous[key] and result[key] > previous[key] * (1 + tolerance):
+                regressions.append('%s %s: %.3f -> %.3f' % (result['name'], key, previous[key], result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the checks in checks.d')
+    parser.add_argument('--runs', type=int, default=5, help='check runs per scenario')
+    parser.add_argument('--instances', type=int, default=4, help='instances per check')
+    parser.add_argument('--tables', type=int, default=5000, help='tables per Redshift cluster')
+    parser.add_argument('--max-tables', type=int, default=None, help='max_tables of the Redshift check')
+    parser.add_argument('--clusters', type=int, default=20, help='clusters returned by describe_clusters')
+    parser.add_argument('--load-balancers', type=int, default=20, help='load balancers per ELB instance')
+    parser.add_argument('--backends', type=int, default=2000, help='backends per load balancer')
+    parser.add_argument('--max-workers', type=int, default=4, help='max_workers of the ELB check')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every AWS API call')
+    parser.add_argument('--sql-latency', type=float, default=0.0, help='seconds added to every SQL statement')
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='seconds added to every connect')
+    parser.add_argument('--only', action='append', help='run only this scenario (repeatable)')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare with a JSON baseline and exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression ratio, default 0.2')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.scenario:
+        print json.dumps(run_scenario(args, args.scenario))
+        return 0
+
+    argv = sys.argv[1:]
+    results = []
+    print '%-20s %10s %10s %10s %12s %14s %9s' % ('scenario', 'mean (s)', 'min (s)', 'max (s)',
+                                                  'peak (MB)', 'metrics/run', 'warnings')
+    for name, _, _ in SCENARIOS:
+        if args.only and name not in args.only:
+            continue
+        result = spawn(argv, name)
+        results.append(result)
+        print '%-20s %10.3f %10.3f %10.3f %12.1f %14d %9d' % (
+            name, result['mean_time'], result['min_time'], result['max_time'],
+            result['peak_rss_mb'], result['metrics_per_run'], result['warnings'])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict((result['name'], result) for result in results), f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
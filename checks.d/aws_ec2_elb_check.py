@@ -1,18 +1,86 @@
 import boto.ec2.elb
-import boto.utils
+import imp
+import os
 import re
+import sys
+import threading
+import time
+
+from collections import Counter, namedtuple
+from multiprocessing.pool import ThreadPool
 
 from checks import AgentCheck
 
 
+STATES = {
+    'InService': 'in_service',
+    'OutOfService': 'out_of_service',
+    'Unknown': 'unknown',
+}
+
+ElbInstance = namedtuple('ElbInstance', [
+    'load_balancer_names', 'discover', 'instance_id',
+    'aws_access_key_id', 'aws_secret_access_key', 'aws_region', 'thresholds', 'tags',
+])
+
+
+def _load_aws_utils():
+    """Return checks.d/aws_utils.py, loaded once so that every check shares its metadata cache."""
+    module = sys.modules.get('checksd_aws_utils')
+    if module is None:
+        module = imp.load_source('checksd_aws_utils',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aws_utils.py'))
+    return module
+
+
+aws_utils = _load_aws_utils()
+get_aws_region = aws_utils.get_aws_region
+get_aws_credentials = aws_utils.get_aws_credentials
+instance_key = aws_utils.instance_key
+RunTimings = aws_utils.RunTimings
+
+
 class AwsEc2ElbCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self.max_workers = self.init_config.get('max_workers', 4)
+        self.max_warning_instances = self.init_config.get('max_warning_instances', 5)
+        self.metadata_timeout = self.init_config.get('metadata_timeout', 1)
+        self.metadata_retries = self.init_config.get('metadata_retries', 3)
+        self.log_timings = self.init_config.get('log_timings', False)
+        self._pool = None
+        # boto connections are not thread safe, every worker keeps its own
+        self._local = threading.local()
+        self._confs = {}
+        self._pending_timings = {}
+        for instance in instances or []:
+            try:
+                self._load_conf(instance)
+            except Exception:
+                # Reported by check() on every run
+                pass
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
     def _load_conf(self, instance):
-        load_balancer_name = instance.get('load_balancer_name')
-        if load_balancer_name is None:
-            raise Exception('Bad configuration. You must specify a load_balancer_name')
+        key = instance_key(instance)
+        if key not in self._confs:
+            timings = RunTimings()
+            self._confs[key] = self._parse_conf(instance, timings)
+            self._pending_timings[key] = timings
+        return self._confs[key]
+
+    def _parse_conf(self, instance, timings):
+        load_balancer_names = list(instance.get('load_balancer_names', []))
+        if instance.get('load_balancer_name') is not None:
+            load_balancer_names.insert(0, instance.get('load_balancer_name'))
+        discover = instance.get('discover_load_balancers', False)
+        if not load_balancer_names and not discover:
+            raise Exception('Bad configuration. You must specify a load_balancer_name, '
+                            'load_balancer_names or discover_load_balancers')
 
         instance_id = instance.get('instance_id')
 
@@ -20,38 +88,77 @@ class AwsEc2ElbCheck(AgentCheck):
         aws_secret_access_key = instance.get('aws_secret_access_key')
         aws_region = instance.get('aws_region')
         if aws_region is None:
-            aws_region = boto.utils.get_instance_metadata()['placement']['availability-zone'][:-1]
+            with timings.phase('metadata'):
+                aws_region = get_aws_region(timeout=self.metadata_timeout, retries=self.metadata_retries)
 
         thresholds = instance.get('thresholds')
 
-        tags = instance.get('tags', [])
+        tags = list(instance.get('tags', []))
         if instance_id is not None:
             tags.append('instance_id:%s' % instance_id)
 
         tags.append('aws_region:%s' % aws_region)
 
-        return load_balancer_name, instance_id, \
-            aws_access_key_id, aws_secret_access_key, aws_region, thresholds, tags
+        return ElbInstance(tuple(load_balancer_names), discover, instance_id,
+                           aws_access_key_id, aws_secret_access_key, aws_region, thresholds, tuple(tags))
+
+    def _connection(self, aws_region, aws_access_key_id, aws_secret_access_key):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+
+        credentials = get_aws_credentials(aws_access_key_id, aws_secret_access_key)
+        key = (aws_region, aws_access_key_id, aws_secret_access_key)
+        # Role credentials rotate, connect again when they did
+        if key not in connections or connections[key][0] != credentials:
+            access_key, secret_key, security_token = credentials
+            elb = boto.ec2.elb.connect_to_region(aws_region,
+                                                 aws_access_key_id=access_key,
+                                                 aws_secret_access_key=secret_key,
+                                                 security_token=security_token)
+            connections[key] = (credentials, elb)
+        return connections[key][1]
+
+    def _discover_load_balancers(self, aws_region, aws_access_key_id, aws_secret_access_key):
+        elb = self._connection(aws_region, aws_access_key_id, aws_secret_access_key)
+        load_balancer_names = []
+        marker = None
+        while True:
+            load_balancers = elb.get_all_load_balancers(marker=marker)
+            load_balancer_names.extend(load_balancer.name for load_balancer in load_balancers)
+            marker = getattr(load_balancers, 'next_marker', None)
+            if not marker:
+                return load_balancer_names
+
+    def _describe_health(self, args):
+        load_balancer_name, instances, aws_region, aws_access_key_id, aws_secret_access_key = args
+        start = time.time()
+        try:
+            elb = self._connection(aws_region, aws_access_key_id, aws_secret_access_key)
+            health_states = elb.describe_instance_health(load_balancer_name, instances=instances)
+            return load_balancer_name, health_states, None, time.time() - start
+        except Exception, e:
+            return load_balancer_name, None, e, time.time() - start
+
+    def _describe_all_health(self, jobs):
+        if len(jobs) <= 1 or self.max_workers <= 1:
+            return map(self._describe_health, jobs)
 
-    def _service_check(self, instance, tags, thresholds, instance_by_state, in_service_index):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_workers)
+        return self._pool.map(self._describe_health, jobs)
+
+    def _service_check(self, instance, tags, thresholds, in_service):
         status = AgentCheck.OK
         if thresholds is None:
             return self.warning('thresholds configuration is empty')
 
-        if in_service_index is not False:
-            count = instance_by_state[in_service_index]['count']
-            threshold = '-'
-
-        if in_service_index is False:
+        threshold = '-'
+        if in_service <= thresholds['critical']:
             status = AgentCheck.CRITICAL
-            count = 0
-        elif instance_by_state[in_service_index]['count'] <= thresholds['critical']:
-            status = AgentCheck.CRITICAL
-            count = instance_by_state[in_service_index]['count']
             threshold = thresholds['critical']
-        elif instance_by_state[in_service_index]['count'] <= thresholds['warning']:
+        elif in_service <= thresholds['warning']:
             status = AgentCheck.WARNING
-            count = instance_by_state[in_service_index]['count']
             threshold = thresholds['warning']
 
         status_str = {
@@ -64,48 +171,79 @@ class AwsEc2ElbCheck(AgentCheck):
             'aws_ec2_elb_check.up_in_service',
             status,
             tags=tags,
-            message=message_str % (status_str[status], count, threshold)
+            message=message_str % (status_str[status], in_service, threshold)
         )
 
+    def _check_load_balancer(self, instance, load_balancer_name, health_states, thresholds, tags):
+        service_check_tags = ( 'load_balancer_name:%s' % load_balancer_name, )
+        tags = tags + service_check_tags
+
+        try:
+            by_state = Counter()
+            by_reason = Counter()
+            unhealthy = []
+            for health_state in health_states:
+                state = STATES.get(health_state.state, 'unknown')
+                by_state[state] += 1
+                if state != 'in_service':
+                    by_reason[(state, health_state.reason_code)] += 1
+                    unhealthy.append(health_state)
+
+            for state in STATES.values():
+                self.gauge('aws_ec2_elb_check.%s' % state, by_state[state], tags=tags)
+            for (state, reason_code), count in by_reason.items():
+                self.gauge('aws_ec2_elb_check.reason_code', count,
+                           tags=tags + ('state:%s' % state, 'reason_code:%s' % reason_code))
+
+            if unhealthy:
+                shown = ', '.join('%s is %s - %s' % (health_state.instance_id, health_state.state,
+                                                     health_state.reason_code)
+                                  for health_state in unhealthy[:self.max_warning_instances])
+                if len(unhealthy) > self.max_warning_instances:
+                    shown += ' and %d more' % (len(unhealthy) - self.max_warning_instances)
+                self.warning('%s has %d unhealthy instances: %s'
+                             % (load_balancer_name, len(unhealthy), shown))
+
+            self._service_check(instance, tags=service_check_tags, thresholds=thresholds,
+                                in_service=by_state['in_service'])
+        except Exception, e:
+            self.warning(e)
+
     def check(self, instance):
-        load_balancer_name, instance_id, \
+        load_balancer_names, discover, instance_id, \
             aws_access_key_id, aws_secret_access_key, aws_region, \
             thresholds, tags = self._load_conf(instance)
-        service_check_tags = [ 'load_balancer_name:%s' % load_balancer_name ]
-
-        elb = boto.ec2.elb.connect_to_region(aws_region,
-                                             aws_access_key_id=aws_access_key_id,
-                                             aws_secret_access_key=aws_secret_access_key)
+        # The metadata lookup of the first parse is reported with the first run
+        timings = self._pending_timings.pop(instance_key(instance), None) or RunTimings()
+        health_timings = []
+
+        if discover:
+            try:
+                with timings.phase('get_all_load_balancers'):
+                    discovered = self._discover_load_balancers(aws_region, aws_access_key_id,
+                                                               aws_secret_access_key)
+            except Exception, e:
+                self.warning(e)
+                discovered = []
+            load_balancer_names += tuple(name for name in discovered if name not in load_balancer_names)
 
         instances = None
         if instance_id is not None:
             instances = [instance_id]
 
-        try:
-            instance_by_state = [
-                { 'state': 'in_service', 'count': 0 },
-                { 'state': 'out_of_service', 'count': 0 },
-                { 'state': 'unknown', 'count': 0 },
-            ]
-            health_states = elb.describe_instance_health(load_balancer_name, instances=instances)
-            for health_state in health_states:
-                if health_state.state == 'InService':
-                    instance_by_state[0]['count'] += 1
-                elif health_state.state == 'OutOfService':
-                    instance_by_state[1]['count'] += 1
-                    self.warning('%s is %s - %s'
-                                 % (health_state.instance_id, health_state.state,
-                                    health_state.reason_code))
-                else:
-                    instance_by_state[2]['count'] += 1
-                    self.warning('%s is %s - %s'
-                                 % (health_state.instance_id, health_state.state,
-                                    health_state.reason_code))
-
-                for state in instance_by_state:
-                    self.gauge('aws_ec2_elb_check.%s' % state['state'], state['count'], tags=tags)
-
-            self._service_check(instance, tags=service_check_tags, thresholds=thresholds,
-                                instance_by_state=instance_by_state, in_service_index=0)
-        except Exception, e:
-            self.warning(e)
+        jobs = [(load_balancer_name, instances, aws_region, aws_access_key_id, aws_secret_access_key)
+                for load_balancer_name in load_balancer_names]
+        for load_balancer_name, health_states, error, duration in self._describe_all_health(jobs):
+            lb_tags = tags + ('load_balancer_name:%s' % load_balancer_name,)
+            self.gauge('aws_ec2_elb_check.timing.describe_instance_health', duration, tags=lb_tags)
+            health_timings.append('%s=%.3fs' % (load_balancer_name, duration))
+            if error is not None:
+                self.warning(error)
+                continue
+            with timings.phase('emit'):
+                self._check_load_balancer(instance, load_balancer_name, health_states, thresholds, tags)
+
+        timings.report(self, 'aws_ec2_elb_check', tags)
+        if self.log_timings:
+            self.log.info('timings: %s, describe_instance_health: %s'
+                          % (timings, ', '.join(health_timings)))
@@ -1,11 +1,23 @@
 import boto.redshift
-import boto.utils
 import datetime
+import functools
+import imp
+import json
+import logging
+import os
 import psycopg2
+import psycopg2.extensions
+import stat
+import sys
+import threading
 import time
 
+from collections import Counter, namedtuple
+
 from checks import AgentCheck
 
+log = logging.getLogger(__name__)
+
 
 QUERY_TABLE_COUNT = """\
 select count(DISTINCT tablename)
@@ -25,23 +37,541 @@ select name, sum(rows) as rows
   group by name
 """
 
+# QUERY_TABLE ranked by the size of svv_table_info, so that max_tables picks the
+# same tables for both per-table queries
+QUERY_TABLE_BY_SIZE = """\
+select p.name, sum(p.rows) as rows, i.size as size
+  from stv_tbl_perm p
+  join svv_table_info i on i.table_id = p.id
+  group by p.name, i.size
+"""
+
 QUERY_TABLE_STATUS = """\
 select "table", size, tbl_rows, skew_rows
   from svv_table_info
 """
 
 QUERY_LOG_TYPE = """\
-select count(*)
+select lower(split_part(trim(substring), ' ', 1)) as query_type, count(*), max(endtime)
   from svl_qlog
-  where starttime >= '%s' and endtime <= '%s' and substring like '%s';
+  where endtime > %s
+    and lower(split_part(trim(substring), ' ', 1)) in %s
+  group by 1
 """
 
-class AwsRedshiftStatus(AgentCheck):
-    def __init__(self, name, init_config, agentConfig, instances=None):
-        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+# One round-trip for every system table family, rows are (family, key, v1, v2, v3).
+# Queued covers Queued and QueuedWaiting; Returning queries still hold their slot
+# and count as running. Run without parameters, so % is not a placeholder
+QUERY_SYSTEM = """\
+select 'wlm'::varchar as family, service_class::varchar as key,
+       sum(case when trim(state) like 'Queued%' then 1 else 0 end)::float8,
+       sum(case when trim(state) in ('Running', 'Returning') then 1 else 0 end)::float8,
+       max(case when trim(state) like 'Queued%' then queue_time else 0 end)::float8 / 1000000
+  from stv_wlm_query_state
+  group by service_class
+union all
+select 'disk'::varchar, owner::varchar, sum(used)::float8, sum(capacity)::float8, 0::float8
+  from stv_partitions
+  where part_begin = 0
+  group by owner
+union all
+select 'inflight'::varchar, ''::varchar, count(distinct query)::float8, 0::float8, 0::float8
+  from stv_inflight
+"""
 
-    def _load_conf(self, instance):
+QUERY_TOP_TABLES = """\
+  order by size desc
+  limit %s
+"""
+
+DEFAULT_QUERY_TYPES = ['select', 'insert', 'update', 'delete', 'analyze']
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser('~'), '.aws_redshift_status')
+
+RedshiftInstance = namedtuple('RedshiftInstance', [
+    'name', 'cluster_name', 'cluster_address', 'cluster_port', 'db_name', 'user_name', 'user_password',
+    'aws_access_key_id', 'aws_secret_access_key', 'aws_region', 'query', 'tags', 'service_check_tags',
+])
+
+
+def _load_aws_utils():
+    """Return checks.d/aws_utils.py, loaded once so that every check shares its metadata cache."""
+    module = sys.modules.get('checksd_aws_utils')
+    if module is None:
+        module = imp.load_source('checksd_aws_utils',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aws_utils.py'))
+    return module
+
+
+aws_utils = _load_aws_utils()
+get_aws_region = aws_utils.get_aws_region
+get_aws_credentials = aws_utils.get_aws_credentials
+instance_key = aws_utils.instance_key
+RunTimings = aws_utils.RunTimings
+
+
+def _load_json(path, default):
+    """Return the JSON document kept in path, or default when there is none."""
+    if path is None:
+        return default
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def _save_json(path, data, **kwargs):
+    """Replace path with data through a rename, keeping state is best effort."""
+    if path is None:
+        return
+    tmp_path = '%s.tmp' % path
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, **kwargs)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def state_path(init_config, filename):
+    """Return filename in the private state directory, or None to keep the state in memory.
+
+    State is not kept in the shared temporary directory, where another user
+    could create or replace the files first.
+    """
+    state_dir = init_config.get('state_dir', DEFAULT_STATE_DIR)
+    try:
+        if not os.path.lexists(state_dir):
+            os.makedirs(state_dir, 0o700)
+        st = os.lstat(state_dir)
+    except OSError, e:
+        log.warning('cannot use %s for state files, keeping state in memory: %s' % (state_dir, e))
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        log.warning('%s must be a directory only accessible by its owner, keeping state in memory' % state_dir)
+        return None
+    return os.path.join(state_dir, filename)
+
+
+def duplicate_names(instances):
+    """Return the names used by more than one instance of the YAML."""
+    counts = Counter(instance.get('name') for instance in instances)
+    return set(name for name, count in counts.items() if name is not None and count > 1)
+
+
+def cluster_key(aws_region, aws_access_key_id, cluster_name):
+    """Return a key for cluster_name, clusters of different accounts may share a name."""
+    return '%s/%s/%s' % (aws_access_key_id or 'default', aws_region, cluster_name)
+
+
+def describe_cluster_endpoints(redshift):
+    """Return {cluster_name: (address, port)} for every cluster in the region.
+
+    Pages through describe_clusters with its marker so that any number of
+    clusters costs one API call per page instead of one per cluster.
+    """
+    endpoints = {}
+    marker = None
+    while True:
+        response = redshift.describe_clusters(marker=marker)
+        result = response['DescribeClustersResponse']['DescribeClustersResult']
+        for cluster in result['Clusters']:
+            # Clusters still being created have no endpoint yet
+            endpoint = cluster.get('Endpoint')
+            if endpoint:
+                endpoints[cluster['ClusterIdentifier']] = (endpoint['Address'], endpoint['Port'])
+        marker = result.get('Marker')
+        if not marker:
+            return endpoints
+
+
+class RedshiftConnectionPool(object):
+    """Keep Redshift connections open between check runs.
+
+    Idle connections are kept per (host, port, db_name, user_name), checked
+    with a cheap query before reuse and closed once they sit idle longer
+    than idle_timeout seconds.
+    """
+
+    def __init__(self, pool_size=1, idle_timeout=900, connect_timeout=3):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, host, port, db_name, user_name, user_password):
+        conn = psycopg2.connect(
+            host=host,
+            port=port,
+            database=db_name,
+            user=user_name,
+            password=user_password,
+            connect_timeout=self.connect_timeout,
+        )
+        # Never leave a transaction open on the leader node between runs
+        conn.autocommit = True
+        return conn
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('select 1')
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self, host, port, db_name, user_name, user_password):
+        key = (host, port, db_name, user_name)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                conn, _ = idle.pop()
+            if self._is_alive(conn):
+                return conn
+            self._close(conn)
+        return self._connect(host, port, db_name, user_name, user_password)
+
+    def release(self, host, port, db_name, user_name, conn, broken=False):
+        key = (host, port, db_name, user_name)
+        if not broken and not conn.closed:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.pool_size:
+                    idle.append((conn, time.time()))
+                    return
+        self._close(conn)
+
+    def evict_idle(self):
+        expired = []
+        now = time.time()
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for conn, since in idle:
+                    if now - since > self.idle_timeout:
+                        expired.append(conn)
+                    else:
+                        keep.append((conn, since))
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for conn in expired:
+            self._close(conn)
+
+    def close_all(self):
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn, _ in idle]
+            self._idle = {}
+        for conn in conns:
+            self._close(conn)
+
+
+class RedshiftEndpointCache(object):
+    """Remember cluster endpoints resolved with describe_clusters.
+
+    Entries expire after ttl seconds and are optionally persisted to a small
+    JSON file so that a restarted collector does not hit the AWS API again.
+    """
+
+    def __init__(self, ttl=3600, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        now = time.time()
+        for key, (address, port, expires) in _load_json(path, {}).items():
+            if expires > now:
+                self._entries[key] = (address, port, expires)
+
+    def get(self, aws_region, aws_access_key_id, cluster_name):
+        key = cluster_key(aws_region, aws_access_key_id, cluster_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > time.time():
+                self.hits += 1
+                return entry[0], entry[1]
+            self.misses += 1
+            return None
+
+    def update(self, aws_region, aws_access_key_id, endpoints):
+        if self.ttl <= 0:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            for cluster_name, (address, port) in endpoints.items():
+                self._entries[cluster_key(aws_region, aws_access_key_id, cluster_name)] = (address, port, expires)
+            _save_json(self.path, self._entries)
+
+    def invalidate(self, aws_region, aws_access_key_id, cluster_name):
+        key = cluster_key(aws_region, aws_access_key_id, cluster_name)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                _save_json(self.path, self._entries)
+
+
+class QueryLogMarks(object):
+    """Remember the newest svl_qlog endtime already counted per instance.
+
+    Marks are kept in a small JSON file so that each run only reads the
+    statements that finished since the previous one, even across restarts.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._marks = _load_json(path, {})
+        self._lock = threading.Lock()
+
+    def _key(self, name, cluster_address, cluster_port, db_name):
+        # Instances watching the same database each count every statement
+        return '%s@%s:%s/%s' % (name, cluster_address, cluster_port, db_name)
+
+    def get(self, name, cluster_address, cluster_port, db_name):
+        with self._lock:
+            return self._marks.get(self._key(name, cluster_address, cluster_port, db_name))
+
+    def set(self, name, cluster_address, cluster_port, db_name, endtime):
+        with self._lock:
+            self._marks[self._key(name, cluster_address, cluster_port, db_name)] = endtime
+            _save_json(self.path, self._marks)
+
+
+class QueryResultCache(object):
+    """Last rows of the expensive catalog queries, refreshed every N runs.
+
+    Rows are optionally kept in a JSON file, which is only rewritten when a
+    query is refreshed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._results = _load_json(path, {})
+        # runs each cached result was reused, when the interval is not known
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, query_name):
+        return '%s/%s' % (name, query_name)
+
+    def get(self, name, query_name, every, interval):
+        """Return the cached rows until they were sent for every runs, or None to refresh them."""
+        key = self._key(name, query_name)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None:
+                return None
+            if interval:
+                # Half an interval of slack so a slightly early run still reuses the rows
+                if time.time() - cached[0] < (every - 0.5) * interval:
+                    return cached[1]
+                return None
+            # Without min_collection_interval the agent runs the check as
+            # often as it can, count the runs instead
+            runs = self._runs.get(key, 0) + 1
+            if runs < every:
+                self._runs[key] = runs
+                return cached[1]
+            return None
+
+    def set(self, name, query_name, rows):
+        key = self._key(name, query_name)
+        with self._lock:
+            self._results[key] = (time.time(), rows)
+            self._runs[key] = 0
+            # numeric columns come back as Decimal
+            _save_json(self.path, self._results, default=float)
+
+
+class ChangedValues(object):
+    """Last value sent per metric and table for the per-table gauges of one instance.
+
+    Between full refreshes, which happen every full_refresh runs, only values
+    that changed since the last run pass. A series not seen during a run is
+    dropped when the run finishes, so dropped tables are not kept.
+    """
+
+    def __init__(self, full_refresh=10):
+        self.full_refresh = full_refresh
+        self.suppressed = 0
+        self._values = {}
+        self._seen = {}
+        self._runs = 0
+        self._refresh = True
+
+    def start(self):
+        self._refresh = self.full_refresh <= 1 or self._runs % self.full_refresh == 0
+        self._runs += 1
+        self._seen = {}
+        self.suppressed = 0
+
+    def changed(self, metric, value, tags):
+        # Only the last tag (table:...) differs between series of one instance
+        table = tags[-1]
+        seen = self._seen.get(metric)
+        if seen is None:
+            seen = self._seen[metric] = {}
+        seen[table] = value
+        if self._refresh or self._values.get(metric, {}).get(table) != value:
+            return True
+        self.suppressed += 1
+        return False
+
+    def finish(self):
+        self._values = self._seen
+        self._seen = {}
+
+
+class ClusterNotFound(Exception):
+    """Raised when describe_clusters does not list a configured cluster_name."""
+
+
+class ClusterUnavailable(Exception):
+    """Raised instead of connecting while the breaker of a cluster is open."""
+
+
+class InstanceCancelled(Exception):
+    """Raised when the caller cancelled an instance that ran for too long."""
+
+
+class CircuitBreaker(object):
+    """Stop connecting to clusters that keep failing.
+
+    After threshold consecutive failures a cluster is skipped for backoff
+    seconds, doubled on every further failure up to max_backoff. The state is
+    kept in a small JSON file so that it survives restarts and cron runs.
+    """
+
+    def __init__(self, threshold=3, backoff=60, max_backoff=3600, path=None):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.path = path
+        # key -> [consecutive failures, open until, last error]
+        self._states = _load_json(path, {})
+        self._lock = threading.Lock()
+
+    def failures(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            return state[0] if state is not None else 0
+
+    def check(self, key):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            state = self._states.get(key)
+            if state is None or state[1] <= time.time():
+                return
+            failures, open_until, error = state
+        raise ClusterUnavailable('%s failed %d times in a row (%s), next attempt in %.0fs'
+                                 % (key, failures, error, open_until - time.time()))
+
+    def success(self, key):
+        with self._lock:
+            if self._states.pop(key, None) is not None:
+                _save_json(self.path, self._states)
+
+    def failure(self, key, error):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            state = self._states.get(key)
+            failures = (state[0] if state is not None else 0) + 1
+            open_until = 0
+            if failures >= self.threshold:
+                exponent = min(failures - self.threshold, 16)
+                open_until = time.time() + min(self.max_backoff, self.backoff * 2 ** exponent)
+            self._states[key] = [failures, open_until, str(error)]
+            _save_json(self.path, self._states)
+
+
+class RedshiftCollector(object):
+    """Collect Redshift status metrics for one instance at a time.
+
+    Metrics go to a sink with gauge(metric, value, tags=...) and
+    increment(metric, tags=...), so the same engine feeds the agent check
+    and the ThreadStats runner in threadstats.d. Connections, endpoints,
+    statement-count marks and refreshed catalog rows are kept here between
+    runs. Default state files are named after state_prefix, so that the
+    agent check and the runner do not overwrite each other's.
+    """
+
+    def __init__(self, init_config, state_prefix='check'):
+        self.pool = RedshiftConnectionPool(
+            pool_size=init_config.get('pool_size', 1),
+            idle_timeout=init_config.get('pool_idle_timeout', 900),
+            connect_timeout=init_config.get('connect_timeout', 3),
+        )
+        self.endpoint_cache = RedshiftEndpointCache(
+            ttl=init_config.get('endpoint_cache_ttl', 3600),
+            path=init_config.get('endpoint_cache_file'),
+        )
+        query_log_state_file = init_config.get('query_log_state_file')
+        if query_log_state_file is None:
+            query_log_state_file = state_path(init_config, '%s_qlog.json' % state_prefix)
+        self.query_log_marks = QueryLogMarks(query_log_state_file)
+        self.query_intervals = init_config.get('query_intervals') or {}
+        self.query_results = QueryResultCache(init_config.get('query_results_file'))
+        circuit_breaker_file = init_config.get('circuit_breaker_file')
+        if circuit_breaker_file is None:
+            circuit_breaker_file = state_path(init_config, '%s_breaker.json' % state_prefix)
+        self.breaker = CircuitBreaker(
+            threshold=init_config.get('circuit_breaker_threshold', 3),
+            backoff=init_config.get('circuit_breaker_backoff', 60),
+            max_backoff=init_config.get('circuit_breaker_max_backoff', 3600),
+            path=circuit_breaker_file,
+        )
+        self.stream_results = init_config.get('stream_results', False)
+        self.fetch_size = init_config.get('fetch_size', 1000)
+        self.max_tables = init_config.get('max_tables')
+        self.metadata_timeout = init_config.get('metadata_timeout', 1)
+        self.metadata_retries = init_config.get('metadata_retries', 3)
+        self.log_timings = init_config.get('log_timings', False)
+        self.statement_timeout = init_config.get('statement_timeout')
+        self.statement_timeouts = init_config.get('statement_timeouts') or {}
+        self.run_timeout = init_config.get('run_timeout')
+        self.emit_changes_only = init_config.get('emit_changes_only', False)
+        self.full_refresh_runs = init_config.get('full_refresh_runs', 10)
+        self._changes = {}
+
+        # svl_qlog statements are matched lower-cased
+        self.query_types = tuple(sorted(set(str(q).strip().lower()
+                                            for q in init_config.get('query_types', DEFAULT_QUERY_TYPES) or [])))
+        if not self.query_types:
+            raise Exception('Bad configuration. query_types must list at least one statement type')
+        self.query_metrics = [(q, 'aws_redshift_status.query.%s' % q) for q in self.query_types]
+
+    def close(self):
+        self.pool.close_all()
+
+    def load_conf(self, instance, timings=None):
+        """Parse and validate one instance of the YAML into a RedshiftInstance."""
+        if timings is None:
+            timings = RunTimings()
+
+        # Cached rows, marks, changed values and runner state are kept per name
         name = instance.get('name')
+        if name is None:
+            raise Exception('Bad configuration. You must specify a name')
+
         cluster_name = instance.get('cluster_name')
         cluster_address = instance.get('cluster_address')
         cluster_port = instance.get('cluster_port')
@@ -64,29 +594,17 @@ class AwsRedshiftStatus(AgentCheck):
         aws_secret_access_key = instance.get('aws_secret_access_key')
         aws_region = instance.get('aws_region')
         if aws_region is None:
-            aws_region = boto.utils.get_instance_metadata()['placement']['availability-zone'][:-1]
+            with timings.phase('metadata'):
+                aws_region = get_aws_region(timeout=self.metadata_timeout, retries=self.metadata_retries)
 
         query = instance.get('query', False)
 
-        tags = instance.get('tags', [])
+        tags = list(instance.get('tags', []))
         tags.append('name:%s' % name)
         if cluster_name is not None:
             tags.append('cluster_name:%s' % cluster_name)
         tags.append('aws_region:%s' % aws_region)
 
-        return name, cluster_name, cluster_address, cluster_port, db_name, user_name, user_password, \
-            aws_access_key_id, aws_secret_access_key, aws_region, query, tags
-
-    def _db_query(self, conn, query):
-        cursor = conn.cursor()
-        cursor.execute(query)
-        return cursor.fetchall()
-
-    def check(self, instance):
-        name, cluster_name, cluster_address, cluster_port, db_name, user_name, user_password, \
-            aws_access_key_id, aws_secret_access_key, aws_region, query, \
-            tags = self._load_conf(instance)
-        start = time.time()
         service_check_tags = [ 'name:%s' % name ]
         if cluster_address is None and cluster_port is None:
             service_check_tags.append('cluster_name:%s' % cluster_name)
@@ -94,85 +612,415 @@ class AwsRedshiftStatus(AgentCheck):
             service_check_tags.append('cluster_address:%s' % cluster_address)
             service_check_tags.append('cluster_port:%s' % cluster_port)
 
-        conn = None
+        return RedshiftInstance(name, cluster_name, cluster_address, cluster_port, db_name, user_name,
+                                user_password, aws_access_key_id, aws_secret_access_key, aws_region,
+                                query, tuple(tags), tuple(service_check_tags))
+
+    def discover_endpoints(self, confs, sink):
+        """Resolve every cluster_name in confs with one listing per region and credentials.
+
+        Endpoints are keyed by (aws_region, aws_access_key_id, cluster_name).
+        Clusters of a region whose listing failed map to None, collect()
+        resolves them on its own.
+        """
+        endpoints = {}
+        groups = {}
+        for name, cluster_name, cluster_address, cluster_port, db_name, user_name, user_password, \
+                aws_access_key_id, aws_secret_access_key, aws_region, query, tags, _ in confs:
+            if cluster_address is not None or cluster_port is not None:
+                continue
+
+            endpoint = self.endpoint_cache.get(aws_region, aws_access_key_id, cluster_name)
+            if endpoint is not None:
+                sink.increment('aws_redshift_status.endpoint_cache.hits', tags=tags)
+                endpoints[(aws_region, aws_access_key_id, cluster_name)] = endpoint
+                continue
+
+            sink.increment('aws_redshift_status.endpoint_cache.misses', tags=tags)
+            groups.setdefault((aws_region, aws_access_key_id, aws_secret_access_key), []).append(cluster_name)
+
+        for (aws_region, aws_access_key_id, aws_secret_access_key), cluster_names in groups.items():
+            log.debug('describe clusters in %s for %s' % (aws_region, ', '.join(cluster_names)))
+            timings = RunTimings()
+            try:
+                with timings.phase('describe_clusters'):
+                    region_endpoints = self._describe_region(aws_region, aws_access_key_id, aws_secret_access_key)
+            except Exception:
+                log.warning('describe clusters in %s failed' % aws_region, exc_info=True)
+                for cluster_name in cluster_names:
+                    endpoints[(aws_region, aws_access_key_id, cluster_name)] = None
+                continue
+            finally:
+                self._report_timings(timings, sink, aws_region, ('aws_region:%s' % aws_region,))
+
+            for cluster_name, endpoint in region_endpoints.items():
+                endpoints[(aws_region, aws_access_key_id, cluster_name)] = endpoint
+
+        return endpoints
+
+    def _describe_region(self, aws_region, aws_access_key_id, aws_secret_access_key):
+        access_key, secret_key, security_token = get_aws_credentials(aws_access_key_id, aws_secret_access_key)
+        redshift = boto.redshift.connect_to_region(aws_region,
+                                                   aws_access_key_id=access_key,
+                                                   aws_secret_access_key=secret_key,
+                                                   security_token=security_token)
+        endpoints = describe_cluster_endpoints(redshift)
+        self.endpoint_cache.update(aws_region, aws_access_key_id, endpoints)
+        return endpoints
+
+    def _report_timings(self, timings, sink, name, tags):
+        timings.report(sink, 'aws_redshift_status', tags)
+        if self.log_timings:
+            log.info('%s timings: %s' % (name, timings))
+
+    def _get_endpoint(self, cluster_name, aws_access_key_id, aws_secret_access_key, aws_region, tags, sink, timings):
+        endpoint = self.endpoint_cache.get(aws_region, aws_access_key_id, cluster_name)
+        if endpoint is not None:
+            sink.increment('aws_redshift_status.endpoint_cache.hits', tags=tags)
+            return endpoint
+        sink.increment('aws_redshift_status.endpoint_cache.misses', tags=tags)
+
+        # List the whole region at once, this warms the cache for every other
+        # instance watching a cluster in the same region
+        with timings.phase('describe_clusters'):
+            endpoints = self._describe_region(aws_region, aws_access_key_id, aws_secret_access_key)
+        if cluster_name not in endpoints:
+            raise ClusterNotFound('Cluster %s is not found' % cluster_name)
+        return endpoints[cluster_name]
+
+    def _statement_timeout(self, query_name, deadline):
+        """Seconds query_name may run, 0 for no limit or None when timeouts are not used."""
+        timeout = self.statement_timeouts.get(query_name, self.statement_timeout)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            timeout = remaining if not timeout else min(timeout, remaining)
+        if timeout is None and (self.statement_timeouts or self.statement_timeout):
+            # Pooled sessions keep the timeout of the previous query
+            timeout = 0
+        return timeout
+
+    def _with_timeout(self, query, timeout):
+        if timeout is None:
+            return query
+        # Sent in the same round-trip, statement_timeout lasts for the session
+        return 'set statement_timeout to %d;\n%s' % (max(1, int(timeout * 1000)) if timeout else 0, query)
+
+    def _db_query(self, conn, query, params=None, timeout=None):
+        query = self._with_timeout(query, timeout)
+        cursor = conn.cursor()
         try:
-            if cluster_address is None and cluster_port is None:
-                redshift = boto.redshift.connect_to_region(aws_region,
-                                                           aws_access_key_id=aws_access_key_id,
-                                                           aws_secret_access_key=aws_secret_access_key)
-                clusters = redshift.describe_clusters(cluster_name)
-                if len(clusters) == 0:
-                    raise Exception('Cluster is empty')
-
-                cluster = clusters['DescribeClustersResponse']['DescribeClustersResult']['Clusters'][0]
-                endpoint = cluster['Endpoint']
-                cluster_address = endpoint['Address']
-                cluster_port = endpoint['Port']
-
-            connect_timeout = self.init_config.get('connect_timeout', 3)
-            conn = psycopg2.connect(
-                host=cluster_address,
-                port=cluster_port,
-                database=db_name,
-                user=user_name,
-                password=user_password,
-                connect_timeout=connect_timeout,
-            )
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
 
-            min_collection_interval = instance.get('min_collection_interval', self.init_config.get(
-                    'min_collection_interval',
-                        self.DEFAULT_MIN_COLLECTION_INTERVAL
-                    )
-            )
-            today = datetime.datetime.utcnow()
-            starttime = (today - datetime.timedelta(seconds=min_collection_interval)).strftime('%Y-%m-%d %H:%M:%S.%f')
-            endtime = today.strftime('%Y-%m-%d %H:%M:%S.%f')
+    def _iter_query(self, conn, query, params=None, timeout=None):
+        # Server-side cursors only live inside a transaction
+        conn.autocommit = False
+        try:
+            if timeout is not None:
+                # A declared cursor takes a single statement, set the timeout first
+                self._db_query(conn, self._with_timeout('select 1', timeout))
+            cursor = conn.cursor('aws_redshift_status')
+            try:
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(self.fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+        finally:
+            if not conn.closed:
+                conn.rollback()
+                conn.autocommit = True
+
+    def _tiered_query(self, conn, name, query_name, query, interval, timings, top_tables=False, timeout=None):
+        every = self.query_intervals.get(query_name, 1)
+        if every > 1:
+            cached = self.query_results.get(name, query_name, every, interval)
+            if cached is not None:
+                return cached
 
+        params = None
+        if top_tables and self.max_tables is not None:
+            query += QUERY_TOP_TABLES
+            params = (self.max_tables,)
+
+        if every > 1:
+            with timings.phase('query.%s' % query_name):
+                results = self._db_query(conn, query, params, timeout)
+            self.query_results.set(name, query_name, results)
+            return results
+        if self.stream_results and top_tables:
+            # Rows are fetched while they are emitted, that time counts as emit
+            return self._iter_query(conn, query, params, timeout)
+        with timings.phase('query.%s' % query_name):
+            return self._db_query(conn, query, params, timeout)
+
+    def collect(self, conf, sink, interval, endpoints=None, on_connect=None, timings=None, cancelled=None):
+        """Run the status queries of one instance and send the results to sink.
+
+        endpoints is the map built by discover_endpoints, when it is not
+        given cluster names are resolved one at a time through the cache.
+        The time spent in every phase is sent as aws_redshift_status.timing.*.
+        Raises ClusterUnavailable without connecting while the breaker of the
+        cluster is open. Queries cancelled by statement_timeout or left when
+        run_timeout is reached are sent as aws_redshift_status.query_skipped.
+        Once the cancelled event is set no other query is issued and
+        InstanceCancelled is raised, the connection is closed instead of
+        going back to the pool.
+        """
+        if timings is None:
+            timings = RunTimings()
+        key = self._breaker_key(conf)
+        try:
+            self._collect(conf, key, sink, interval, endpoints, on_connect, timings, cancelled)
+        finally:
+            sink.gauge('aws_redshift_status.consecutive_failures', self.breaker.failures(key), tags=conf.tags)
+            self._report_timings(timings, sink, conf.name, conf.tags)
+
+    def _breaker_key(self, conf):
+        if conf.cluster_address is None and conf.cluster_port is None:
+            return cluster_key(conf.aws_region, conf.aws_access_key_id, conf.cluster_name)
+        return '%s:%s' % (conf.cluster_address, conf.cluster_port)
+
+    def _collect(self, conf, key, sink, interval, endpoints, on_connect, timings, cancelled):
+        name, cluster_name, cluster_address, cluster_port, db_name, user_name, user_password, \
+            aws_access_key_id, aws_secret_access_key, aws_region, query, \
+            tags, _ = conf
+        start = time.time()
+        deadline = start + self.run_timeout if self.run_timeout else None
+
+        self.breaker.check(key)
+        self.pool.evict_idle()
+        resolved = cluster_address is None and cluster_port is None
+        if resolved:
+            # Only a missing or unreachable cluster trips the breaker, a failing
+            # describe_clusters call or query does not
+            try:
+                endpoint = None
+                if endpoints is not None:
+                    if (aws_region, aws_access_key_id, cluster_name) not in endpoints:
+                        raise ClusterNotFound('Cluster %s is not found' % cluster_name)
+                    endpoint = endpoints[(aws_region, aws_access_key_id, cluster_name)]
+                if endpoint is None:
+                    # Not listed up front, or the listing of its region failed
+                    endpoint = self._get_endpoint(cluster_name, aws_access_key_id, aws_secret_access_key,
+                                                  aws_region, tags, sink, timings)
+                cluster_address, cluster_port = endpoint
+            except ClusterNotFound, e:
+                self.breaker.failure(key, e)
+                raise
+
+        try:
+            with timings.phase('connect'):
+                conn = self.pool.acquire(cluster_address, cluster_port, db_name,
+                                         user_name, user_password)
+        except Exception, e:
+            # The cluster may have moved (resize, restore), look it up again next run
+            if resolved:
+                self.endpoint_cache.invalidate(aws_region, aws_access_key_id, cluster_name)
+            self.breaker.failure(key, e)
+            raise
+        self.breaker.success(key)
+
+        broken = False
+        try:
+            if on_connect is not None:
+                on_connect(conn)
             if query:
-                results = self._db_query(conn, QUERY_TABLE_COUNT)
-                self.gauge('aws.redshift_status.table_count', results[0][0], tags=tags)
-
-                results = self._db_query(conn, QUERY_NODE)
-                for row in results:
-                    gauge_tags = tags[:]
-                    gauge_tags.append('node:%d' % row[0])
-                    self.gauge('aws_redshift_status.node_slice', row[1], tags=gauge_tags)
-
-                results = self._db_query(conn, QUERY_TABLE)
-                for row in results:
-                    gauge_tags = tags[:]
-                    gauge_tags.append('table:%s' % row[0])
-                    self.gauge('aws_redshift_status.table', row[1], tags=gauge_tags)
-
-                results = self._db_query(conn, QUERY_TABLE_STATUS)
-                for row in results:
-                    gauge_tags = tags[:]
-                    gauge_tags.append('table:%s' % row[0])
-                    self.gauge('aws_redshift_status.table_status.size', row[1], tags=gauge_tags)
-                    self.gauge('aws_redshift_status.table_status.tbl_rows', row[2], tags=gauge_tags)
-                    self.gauge('aws_redshift_status.table_status.skew_rows', row[3], tags=gauge_tags)
-
-                for q in [ 'select', 'insert', 'update', 'delete', 'analyze' ]:
-                    results = self._db_query(conn, QUERY_LOG_TYPE % (starttime, endtime, '%s %%' % q))
-                    for row in results:
-                        self.gauge('aws_redshift_status.query.%s' % q, row[0], tags=tags)
-
-                running_time = time.time() - start
-                self.gauge('aws_redshift_status.response_time', running_time, tags=tags)
+                self._collect_queries(conn, name, cluster_address, cluster_port, db_name,
+                                      tags, sink, interval, timings, deadline, cancelled)
+                sink.gauge('aws_redshift_status.response_time', time.time() - start, tags=tags)
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.pool.release(cluster_address, cluster_port, db_name, user_name,
+                              conn, broken=broken)
+
+    def _collect_queries(self, conn, name, cluster_address, cluster_port, db_name, tags, sink, interval, timings,
+                         deadline=None, cancelled=None):
+        steps = (
+            ('table_count', self._collect_table_count),
+            ('node', self._collect_node),
+            ('table', self._collect_table),
+            ('table_status', self._collect_table_status),
+            ('system', self._collect_system),
+            ('query_log', functools.partial(self._collect_query_log, cluster_address, cluster_port, db_name)),
+        )
+        changes = None
+        table_gauge = sink.gauge
+        if self.emit_changes_only:
+            changes = self._changes.get(name)
+            if changes is None:
+                changes = self._changes[name] = ChangedValues(self.full_refresh_runs)
+            changes.start()
+
+            def table_gauge(metric, value, tags=None):
+                if changes.changed(metric, value, tags):
+                    sink.gauge(metric, value, tags=tags)
+
+        skipped = []
+        for query_name, step in steps:
+            if cancelled is not None and cancelled.is_set():
+                raise InstanceCancelled('%s: cancelled before query %s' % (name, query_name))
+            if deadline is not None and time.time() >= deadline:
+                skipped.append(query_name)
+                continue
+            timeout = self._statement_timeout(query_name, deadline)
+            gauge = table_gauge if query_name in ('table', 'table_status') else sink.gauge
+            try:
+                step(conn, name, tags, gauge, interval, timings, timeout)
+            except psycopg2.extensions.QueryCanceledError:
+                if cancelled is not None and cancelled.is_set():
+                    raise InstanceCancelled('%s: query %s was cancelled' % (name, query_name))
+                # Metrics of the other queries are still sent
+                log.warning('%s: query %s was cancelled after %.1fs' % (name, query_name, timeout or 0))
+                skipped.append(query_name)
+
+        if changes is not None:
+            # Series of skipped queries are forgotten and sent in full next run
+            changes.finish()
+            sink.gauge('aws_redshift_status.suppressed_points', changes.suppressed, tags=tags)
+
+        for query_name in skipped:
+            sink.increment('aws_redshift_status.query_skipped', tags=tags + ('query_name:%s' % query_name,))
+        if deadline is not None and time.time() >= deadline:
+            log.warning('%s: run exceeded run_timeout, skipped %s' % (name, ', '.join(skipped) or 'nothing'))
+            sink.increment('aws_redshift_status.deadline_exceeded', tags=tags)
+
+    def _collect_table_count(self, conn, name, tags, gauge, interval, timings, timeout):
+        results = self._tiered_query(conn, name, 'table_count', QUERY_TABLE_COUNT, interval, timings,
+                                     timeout=timeout)
+        with timings.phase('emit'):
+            gauge('aws.redshift_status.table_count', results[0][0], tags=tags)
+
+    def _collect_node(self, conn, name, tags, gauge, interval, timings, timeout):
+        results = self._tiered_query(conn, name, 'node', QUERY_NODE, interval, timings, timeout=timeout)
+        with timings.phase('emit'):
+            for row in results:
+                gauge('aws_redshift_status.node_slice', row[1], tags=tags + ('node:%s' % row[0],))
+
+    def _collect_table(self, conn, name, tags, gauge, interval, timings, timeout):
+        query = QUERY_TABLE if self.max_tables is None else QUERY_TABLE_BY_SIZE
+        results = self._tiered_query(conn, name, 'table', query, interval, timings,
+                                     top_tables=True, timeout=timeout)
+        with timings.phase('emit'):
+            for row in results:
+                gauge('aws_redshift_status.table', row[1], tags=tags + ('table:%s' % row[0],))
+
+    def _collect_table_status(self, conn, name, tags, gauge, interval, timings, timeout):
+        results = self._tiered_query(conn, name, 'table_status', QUERY_TABLE_STATUS, interval, timings,
+                                     top_tables=True, timeout=timeout)
+        with timings.phase('emit'):
+            for row in results:
+                table_tags = tags + ('table:%s' % row[0],)
+                gauge('aws_redshift_status.table_status.size', row[1], tags=table_tags)
+                gauge('aws_redshift_status.table_status.tbl_rows', row[2], tags=table_tags)
+                gauge('aws_redshift_status.table_status.skew_rows', row[3], tags=table_tags)
 
+    def _collect_system(self, conn, name, tags, gauge, interval, timings, timeout):
+        results = self._tiered_query(conn, name, 'system', QUERY_SYSTEM, interval, timings, timeout=timeout)
+        with timings.phase('emit'):
+            for family, key, v1, v2, v3 in results:
+                if family == 'wlm':
+                    wlm_tags = tags + ('service_class:%s' % key,)
+                    gauge('aws_redshift_status.wlm.queued', v1, tags=wlm_tags)
+                    gauge('aws_redshift_status.wlm.running', v2, tags=wlm_tags)
+                    gauge('aws_redshift_status.wlm.max_queue_time', v3, tags=wlm_tags)
+                elif family == 'disk':
+                    # used and capacity are counted in 1 MB blocks
+                    node_tags = tags + ('node:%s' % key,)
+                    gauge('aws_redshift_status.disk.used', v1, tags=node_tags)
+                    gauge('aws_redshift_status.disk.capacity', v2, tags=node_tags)
+                    if v2:
+                        gauge('aws_redshift_status.disk.used_pct', 100.0 * v1 / v2, tags=node_tags)
+                elif family == 'inflight':
+                    gauge('aws_redshift_status.inflight', v1, tags=tags)
+
+    def _collect_query_log(self, cluster_address, cluster_port, db_name, conn, name, tags, gauge, interval,
+                           timings, timeout):
+        last_endtime = self.query_log_marks.get(name, cluster_address, cluster_port, db_name)
+        if last_endtime is None:
+            today = datetime.datetime.utcnow()
+            last_endtime = (today - datetime.timedelta(seconds=interval)).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+        counts = dict((q, 0) for q in self.query_types)
+        with timings.phase('query.query_log'):
+            results = self._db_query(conn, QUERY_LOG_TYPE, (last_endtime, self.query_types), timeout)
+        for row in results:
+            counts[row[0]] = row[1]
+        if results:
+            newest = max(row[2] for row in results)
+            self.query_log_marks.set(name, cluster_address, cluster_port, db_name,
+                                     newest.strftime('%Y-%m-%d %H:%M:%S.%f'))
+        with timings.phase('emit'):
+            for q, metric in self.query_metrics:
+                gauge(metric, counts[q], tags=tags)
+
+
+class AwsRedshiftStatus(AgentCheck):
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self.collector = RedshiftCollector(self.init_config)
+        self._duplicate_names = duplicate_names(instances or [])
+        self._confs = {}
+        self._pending_timings = {}
+        for instance in instances or []:
+            try:
+                self._load_conf(instance)
+            except Exception:
+                # Reported by check() on every run
+                pass
+
+    def stop(self):
+        self.collector.close()
+
+    def _load_conf(self, instance):
+        if instance.get('name') in self._duplicate_names:
+            raise Exception('Bad configuration. name %s is used by another instance' % instance.get('name'))
+        key = instance_key(instance)
+        if key not in self._confs:
+            timings = RunTimings()
+            self._confs[key] = self.collector.load_conf(instance, timings)
+            self._pending_timings[key] = timings
+        return self._confs[key]
+
+    def check(self, instance):
+        conf = self._load_conf(instance)
+        # The metadata lookup of the first parse is reported with the first run
+        timings = self._pending_timings.pop(instance_key(instance), None)
+
+        min_collection_interval = instance.get('min_collection_interval', self.init_config.get(
+                'min_collection_interval',
+                    self.DEFAULT_MIN_COLLECTION_INTERVAL
+                )
+        )
+
+        try:
+            self.collector.collect(conf, self, min_collection_interval, timings=timings)
             self.service_check(
                 'aws_redshift_status.up',
                 AgentCheck.OK,
-                tags=service_check_tags,
+                tags=conf.service_check_tags,
+            )
+        except ClusterUnavailable, e:
+            self.warning(e)
+            self.service_check(
+                'aws_redshift_status.up',
+                AgentCheck.CRITICAL,
+                tags=conf.service_check_tags,
+                message='Skipped - %s' % (e)
             )
         except Exception, e:
             self.warning(e)
             self.service_check(
                 'aws_redshift_status.up',
                 AgentCheck.WARNING,
-                tags=tags,
+                tags=conf.tags,
                 message='Exception - %s' % (e)
             )
-        finally:
-            if conn:
-                conn.close()
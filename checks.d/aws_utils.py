@@ -0,0 +1,86 @@
+"""Helpers shared by the AWS checks in checks.d.
+
+checks.d is not on sys.path and this module has no configuration in
+conf.d, the checks load it with imp.load_source, see _load_aws_utils().
+"""
+import boto.provider
+import boto.utils
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+_metadata_lock = threading.Lock()
+_aws_region = None
+_providers = {}
+
+
+def get_aws_region(timeout=1, retries=3, backoff=0.5):
+    """Return the region of this EC2 host, asking the metadata service once per process."""
+    global _aws_region
+    with _metadata_lock:
+        for attempt in range(retries):
+            if _aws_region is not None:
+                break
+            try:
+                placement = boto.utils.get_instance_metadata(data='meta-data/placement/',
+                                                             timeout=timeout, num_retries=1)
+                if placement:
+                    _aws_region = placement['availability-zone'][:-1]
+                    break
+            except Exception:
+                pass
+            if attempt + 1 < retries:
+                time.sleep(backoff * 2 ** attempt)
+        if _aws_region is None:
+            raise Exception('Cannot get aws_region from instance metadata, please set aws_region')
+        return _aws_region
+
+
+def get_aws_credentials(aws_access_key_id=None, aws_secret_access_key=None):
+    """Return (access_key, secret_key, security_token) resolved once per process.
+
+    boto looks the keys up in the environment, its config files or the IAM
+    role of the host, and only asks the metadata service again when role
+    credentials are about to expire.
+    """
+    key = (aws_access_key_id, aws_secret_access_key)
+    with _metadata_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = _providers[key] = boto.provider.Provider('aws', aws_access_key_id, aws_secret_access_key)
+        return provider.access_key, provider.secret_key, provider.security_token
+
+
+def instance_key(instance):
+    """Return a key for the contents of instance.
+
+    AgentCheck.run() hands a deep copy of the instance to every check(), so the
+    parsed configurations cannot be cached by the identity of the dict.
+    """
+    return json.dumps(instance, sort_keys=True, default=str)
+
+
+class RunTimings(object):
+    """Wall time spent in each collection phase during one run."""
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def report(self, sink, prefix, tags):
+        for name, duration in self.phases.items():
+            sink.gauge('%s.timing.%s' % (prefix, name), duration, tags=tags)
+
+    def __str__(self):
+        return ', '.join('%s=%.3fs' % phase for phase in self.phases.items())
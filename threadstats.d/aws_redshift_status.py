@@ -1,11 +1,12 @@
 import argparse
-import boto.redshift
-import boto.utils
-import datetime
+import imp
 import logging
 import os
 import psycopg2
+import Queue
+import signal
 import sys
+import threading
 import time
 import yaml
 
@@ -18,43 +19,39 @@ from logging import getLogger, StreamHandler, DEBUG
 sys.path.append('/opt/datadog-agent/agent')
 import config
 
+# The collector engine is shared with the agent check, see checks.d/aws_redshift_status.py
+aws_redshift_status = imp.load_source(
+    'checksd_aws_redshift_status',
+    os.path.join(os.environ.get('DATADOG_CHECKSD', '/etc/dd-agent/checks.d'), 'aws_redshift_status.py'))
 
-QUERY_TABLE_COUNT = """\
-select count(DISTINCT tablename)
-  from pg_table_def where schemaname = 'public'
-"""
 
-QUERY_NODE = """\
-select node, sum(rows)
-  from stv_slices m
-  join stv_tbl_perm s on s.slice = m.slice
-  group by node
-"""
+class DebugStats(object):
+    """Log every metric sent to ThreadStats, used with --debug."""
 
-QUERY_TABLE_RECORD = """\
-select name, sum(rows) as rows
-  from stv_tbl_perm
-  group by name
-"""
+    def __init__(self, stats):
+        self.stats = stats
 
-QUERY_TABLE_STATUS = """\
-select "table", size, tbl_rows, skew_rows
-  from svv_table_info
-"""
+    def gauge(self, metric, value, tags=None):
+        logging.debug('%s is %s' % (metric, value))
+        self.stats.gauge(metric, value, tags=tags)
+
+    def increment(self, metric, tags=None):
+        logging.debug('%s is incremented' % metric)
+        self.stats.increment(metric, tags=tags)
 
-QUERY_LOG_TYPE = """\
-select count(*)
-  from svl_qlog
-  where starttime >= '%s' and endtime <= '%s' and substring like '%s';
-"""
 
 class AwsRedshiftStatus:
     def __init__(self, config):
         parser = argparse.ArgumentParser()
         parser.add_argument('--from-cron', action='store_true')
         parser.add_argument('--debug', action='store_true')
+        parser.add_argument('--daemon', action='store_true',
+                            help='keep running and collect every min_collection_interval')
         args = parser.parse_args()
 
+        self.debug = args.debug
+        self.daemon = args.daemon
+
         log_level = logging.INFO
         if args.from_cron:
             log_level = logging.WARN
@@ -83,147 +80,220 @@ class AwsRedshiftStatus:
 
         initialize(api_key=api_key)
 
-    def _load_conf(self, instance):
-        name = instance.get('name')
-        cluster_name = instance.get('cluster_name')
-        cluster_address = instance.get('cluster_address')
-        cluster_port = instance.get('cluster_port')
-        if cluster_name is None and cluster_address is None and cluster_port is None:
-            raise Exception('Bad configuration. You must specify a cluster_name or cluster_address and cluster_port')
-
-        db_name = instance.get('db_name')
-        if db_name is None:
-            raise Exception('Bad configuration. You must specify a db_name')
-
-        user_name = instance.get('user_name')
-        if user_name is None:
-            raise Exception('Bad configuration. You must specify a user_name')
-
-        user_password = instance.get('user_password')
-        if user_password is None:
-            raise Exception('Bad sconfiguration. You must specify a user_password')
-
-        aws_access_key_id = instance.get('aws_access_key_id')
-        aws_secret_access_key = instance.get('aws_secret_access_key')
-        aws_region = instance.get('aws_region')
-        if aws_region is None:
-            aws_region = boto.utils.get_instance_metadata()['placement']['availability-zone'][:-1]
-
-        query = instance.get('query', False)
-
-        tags = instance.get('tags', [])
-        tags.append('name:%s' % name)
-        if cluster_name is not None:
-            tags.append('cluster_name:%s' % cluster_name)
-        tags.append('aws_region:%s' % aws_region)
-
-        return name, cluster_name, cluster_address, cluster_port, db_name, user_name, user_password, \
-            aws_access_key_id, aws_secret_access_key, aws_region, query, tags
-
-    def _db_query(self, conn, query):
-        cursor = conn.cursor()
-        cursor.execute(query)
-        return cursor.fetchall()
+    def _track(self, name, conn):
+        with self._active_lock:
+            if name in self._active:
+                self._active[name][1] = conn
+
+    def _cancel_overdue(self, instance_timeout):
+        now = time.time()
+        overdue = []
+        with self._active_lock:
+            for name, (started, conn, cancelled) in self._active.items():
+                if not cancelled.is_set() and now - started > instance_timeout:
+                    # The worker issues no other query once cancelled is set, and
+                    # closes the connection instead of returning it to the pool
+                    cancelled.set()
+                    if conn is not None:
+                        overdue.append((name, conn))
+        for name, conn in overdue:
+            logging.warning('instance %s exceeded %ss, cancelling its queries' % (name, instance_timeout))
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                logging.warning(sys.exc_info())
+
+    def _worker(self, queue):
+        while True:
+            try:
+                conf = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            name = conf.name
+            tags = conf.tags
+            logging.debug('instance name is %s' % name)
+            start = time.time()
+            cancelled = threading.Event()
+            with self._active_lock:
+                self._active[name] = [start, None, cancelled]
+            try:
+                self.collector.collect(conf, self.sink, self.interval, endpoints=self.endpoints,
+                                       on_connect=lambda conn: self._track(name, conn),
+                                       timings=self.timings[name], cancelled=cancelled)
+            except aws_redshift_status.ClusterUnavailable, e:
+                logging.warning('instance %s is skipped: %s' % (name, e))
+            except aws_redshift_status.InstanceCancelled, e:
+                logging.warning('instance %s is cancelled: %s' % (name, e))
+            except Exception:
+                logging.warning(sys.exc_info())
+            finally:
+                with self._active_lock:
+                    del self._active[name]
+                self.sink.gauge('aws_redshift_status.instance_time', time.time() - start, tags=tags)
+
+    def _collect(self, confs, max_workers, instance_timeout):
+        queue = Queue.Queue()
+        for conf in confs:
+            queue.put(conf)
+
+        self._active = {}
+        self._active_lock = threading.Lock()
+        workers = []
+        for _ in range(max(1, min(max_workers, len(confs)))):
+            worker = threading.Thread(target=self._worker, args=(queue,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        while any(worker.is_alive() for worker in workers):
+            self._cancel_overdue(instance_timeout)
+            time.sleep(0.5)
+
+    def _configure(self, yaml_data):
+        init_config = yaml_data['init_config']
+        init_config.setdefault('connect_timeout', 5)
+        # Each cron run is a new process, keep the refreshed rows in a file
+        if init_config.get('query_results_file') is None:
+            init_config['query_results_file'] = aws_redshift_status.state_path(init_config,
+                                                                              'threadstats_results.json')
+        # Stop issuing queries before the watchdog has to cancel them
+        init_config.setdefault('run_timeout',
+                               init_config.get('instance_timeout', init_config.get('min_collection_interval', 300)))
+        # State files are not shared with the agent check, which may watch the same instances
+        collector = aws_redshift_status.RedshiftCollector(init_config, state_prefix='threadstats')
+
+        confs = []
+        timings = {}
+        # Workers, timings and cached rows are kept per name
+        duplicates = aws_redshift_status.duplicate_names(yaml_data['instances'])
+        for instance in yaml_data['instances']:
+            if instance.get('name') in duplicates:
+                logging.warning('instance %s is skipped, its name is used by another instance' % instance.get('name'))
+                continue
+            # This runner always ran the status queries, unlike the agent check
+            instance.setdefault('query', True)
+            conf_timings = aws_redshift_status.RunTimings()
+            try:
+                conf = collector.load_conf(instance, conf_timings)
+            except Exception:
+                # A broken instance must not stop the others from being collected
+                logging.warning(sys.exc_info())
+                continue
+            confs.append(conf)
+            # The metadata lookup is reported with the first run
+            timings[conf.name] = conf_timings
+
+        previous = getattr(self, 'collector', None)
+        self.interval = init_config.get('min_collection_interval', 300)
+        self.max_workers = init_config.get('max_workers', 1)
+        self.instance_timeout = init_config.get('instance_timeout', self.interval)
+        self.collector = collector
+        self.confs = confs
+        self.timings = timings
+        if previous is not None:
+            previous.close()
+
+    def _run(self):
+        start = time.time()
+        # Clusters of a region whose listing failed are resolved by their own worker
+        self.endpoints = self.collector.discover_endpoints(self.confs, self.sink)
+        self._collect(self.confs, self.max_workers, self.instance_timeout)
+        self.sink.gauge('aws_redshift_status.run_time', time.time() - start)
+        self.timings = dict((conf.name, aws_redshift_status.RunTimings()) for conf in self.confs)
+
+    def _yaml_file(self):
+        return os.environ.get('DATADOG_CONF', '%s/aws_redshift_status.yaml' % config.get_confd_path())
 
     def check(self):
         logging.info('check info')
         try:
-            yaml_file = os.environ.get('DATADOG_CONF',
-                                       '%s/aws_redshift_status.yaml' % config.get_confd_path())
-            yaml_data = yaml.load(file(yaml_file))
-            init_config = yaml_data['init_config']
-            interval = init_config.get('min_collection_interval', 300)
+            yaml_data = yaml.load(file(self._yaml_file()))
+            self._configure(yaml_data)
 
             stats = ThreadStats()
             stats.start(flush_interval=10, roll_up_interval=1, device=None,
                         flush_in_thread=False, flush_in_greenlet=False, disabled=False)
+            self.sink = DebugStats(stats) if self.debug else stats
 
-            start = time.time()
-            for instance in yaml_data['instances']:
-                logging.debug('instance name is %s' % instance['name'])
-
-                name, cluster_name, cluster_address, cluster_port, db_name, user_name, user_password, \
-                    aws_access_key_id, aws_secret_access_key, aws_region, query, \
-                    tags = self._load_conf(instance)
-
-                if cluster_address is None and cluster_port is None:
-                    redshift = boto.redshift.connect_to_region(aws_region,
-                                                               aws_access_key_id=aws_access_key_id,
-                                                               aws_secret_access_key=aws_secret_access_key)
-                    clusters = redshift.describe_clusters(cluster_name)
-                    if len(clusters) == 0:
-                        raise Exception('Cluster is empty')
-
-                    cluster = clusters['DescribeClustersResponse']['DescribeClustersResult']['Clusters'][0]
-                    endpoint = cluster['Endpoint']
-                    cluster_address = endpoint['Address']
-                    cluster_port = endpoint['Port']
-
-                conn = None
-                try:
-                    connect_timeout = init_config.get('connect_timeout', 5)
-                    conn = psycopg2.connect(
-                        host=cluster_address,
-                        port=cluster_port,
-                        database=db_name,
-                        user=user_name,
-                        password=user_password,
-                        connect_timeout=connect_timeout,
-                    )
-
-                    today = datetime.datetime.utcnow()
-                    starttime = (today - datetime.timedelta(seconds=interval)).strftime('%Y-%m-%d %H:%M:%S.%f')
-                    endtime = today.strftime('%Y-%m-%d %H:%M:%S.%f')
-
-                    results = self._db_query(conn, QUERY_TABLE_COUNT)
-                    stats.gauge('aws.redshift_status.table_count', results[0][0], tags=tags)
-                    logging.debug('aws.redshift_status.table_count is %s' % results[0][0])
-
-                    results = self._db_query(conn, QUERY_NODE)
-                    for row in results:
-                        gauge_tags = tags[:]
-                        gauge_tags.append('node:%s' % row[0])
-                        stats.gauge('aws_redshift_status.node_slice', row[1], tags=gauge_tags)
-                        logging.debug('aws_redshift_status.node_slice is %s' % row[1])
-
-                    results = self._db_query(conn, QUERY_TABLE_RECORD)
-                    for row in results:
-                        gauge_tags = tags[:]
-                        gauge_tags.append('table:%s' % row[0])
-                        stats.gauge('aws_redshift_status.table_records', row[1], tags=gauge_tags)
-                        logging.debug('aws_redshift_status.table_records is %s' % row[1])
-
-                    results = self._db_query(conn, QUERY_TABLE_STATUS)
-                    for row in results:
-                        gauge_tags = tags[:]
-                        gauge_tags.append('table:%s' % row[0])
-                        stats.gauge('aws_redshift_status.table_status.size', row[1], tags=gauge_tags)
-                        logging.debug('aws_redshift_status.table_status.size is %s' % row[1])
-                        stats.gauge('aws_redshift_status.table_status.tbl_rows', row[2], tags=gauge_tags)
-                        logging.debug('aws_redshift_status.table_status.tbl_rows is %s' % row[2])
-                        stats.gauge('aws_redshift_status.table_status.skew_rows', row[3], tags=gauge_tags)
-                        logging.debug('aws_redshift_status.table_status.skew_rows is %s' % row[3])
-
-                    for q in [ 'select', 'insert', 'update', 'delete', 'analyze' ]:
-                        results = self._db_query(conn, QUERY_LOG_TYPE % (starttime, endtime, '%s %%' % q))
-                        for row in results:
-                            stats.gauge('aws_redshift_status.query.%s' % q, row[0], tags=tags)
-                            logging.debug('aws_redshift_status.query.%s is %s' % (q, row[0]))
-
-                        running_time = time.time() - start
-                        stats.gauge('aws_redshift_status.response_time', running_time, tags=tags)
-                        logging.debug('aws_redshift_status.response_time is %s' % running_time)
-                finally:
-                    if conn:
-                        conn.close()
+            self._run()
 
+            self.collector.close()
             stats.flush()
             stop = stats.stop()
             logging.debug('Stopping is %s' % stop)
         except Exception:
             logging.warning(sys.exc_info())
 
+    def _reload(self, yaml_file, mtime):
+        """Re-read the YAML when its mtime changed, return the mtime in use."""
+        try:
+            current = os.stat(yaml_file).st_mtime
+            if current == mtime:
+                return mtime
+            logging.info('loading %s' % yaml_file)
+            self._configure(yaml.load(file(yaml_file)))
+            return current
+        except Exception:
+            if mtime is None:
+                raise
+            # Keep collecting with the previous configuration
+            logging.warning(sys.exc_info())
+            return mtime
+
+    def run_forever(self):
+        """Collect every min_collection_interval in one long-running process.
+
+        Connections, caches and the ThreadStats flush thread are kept between
+        runs. Runs are scheduled on fixed interval boundaries so their own
+        duration does not make the schedule drift, and runs that could not
+        start in time are skipped instead of piling up.
+        """
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            logging.info('received signal %s, stopping' % signum)
+            stopping.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        stats = ThreadStats()
+        stats.start(flush_interval=10, roll_up_interval=1, device=None,
+                    flush_in_thread=True, flush_in_greenlet=False, disabled=False)
+        self.sink = DebugStats(stats) if self.debug else stats
+
+        yaml_file = self._yaml_file()
+        mtime = self._reload(yaml_file, None)
+        next_run = time.time()
+        while not stopping.is_set():
+            interval = self.interval
+            try:
+                self._run()
+            except Exception:
+                logging.warning(sys.exc_info())
+
+            next_run += interval
+            now = time.time()
+            if next_run < now:
+                missed = int((now - next_run) // interval) + 1
+                logging.warning('run took longer than %ss, skipping %d run(s)' % (interval, missed))
+                next_run += missed * interval
+            stopping.wait(next_run - now)
+            if stopping.is_set():
+                break
+
+            mtime = self._reload(yaml_file, mtime)
+            if self.interval != interval:
+                next_run = time.time()
+
+        self.collector.close()
+        stats.flush()
+        stats.stop()
+
 
 if __name__ == '__main__':
     status = AwsRedshiftStatus(config)
-    status.check()
+    if status.daemon:
+        status.run_forever()
+    else:
+        status.check()